@@ -24,16 +24,6 @@ from torch.nn import CrossEntropyLoss, MSELoss
 
 from transformers import RobertaConfig, BertConfig
 from transformers import BertPreTrainedModel, RobertaModel, BertModel
-from transformers.modeling_bert import BERT_PRETRAINED_MODEL_ARCHIVE_MAP
-
-ROBERTA_PRETRAINED_MODEL_ARCHIVE_MAP = {
-    "roberta-base": "https://s3.amazonaws.com/models.huggingface.co/bert/roberta-base-pytorch_model.bin",
-    "roberta-large": "https://s3.amazonaws.com/models.huggingface.co/bert/roberta-large-pytorch_model.bin",
-    "roberta-large-mnli": "https://s3.amazonaws.com/models.huggingface.co/bert/roberta-large-mnli-pytorch_model.bin",
-    "distilroberta-base": "https://s3.amazonaws.com/models.huggingface.co/bert/distilroberta-base-pytorch_model.bin",
-    "roberta-base-openai-detector": "https://s3.amazonaws.com/models.huggingface.co/bert/roberta-base-openai-detector-pytorch_model.bin",
-    "roberta-large-openai-detector": "https://s3.amazonaws.com/models.huggingface.co/bert/roberta-large-openai-detector-pytorch_model.bin",
-}
 
 logger = logging.getLogger(__name__)
 
@@ -59,7 +49,6 @@ class RobertaClassificationHead(nn.Module):
 
 class RobertaForSequenceClassificationGLUE(BertPreTrainedModel):
     config_class = RobertaConfig
-    pretrained_model_archive_map = ROBERTA_PRETRAINED_MODEL_ARCHIVE_MAP
     base_model_prefix = "roberta"
 
     def __init__(self, config):
@@ -162,7 +151,6 @@ class RobertaForSequenceClassificationGLUE(BertPreTrainedModel):
 
 class RobertaForEmbedding(BertPreTrainedModel):
     config_class = RobertaConfig
-    pretrained_model_archive_map = ROBERTA_PRETRAINED_MODEL_ARCHIVE_MAP
     base_model_prefix = "roberta"
 
     def __init__(self, config):
@@ -201,7 +189,6 @@ class RobertaForEmbedding(BertPreTrainedModel):
 
 class BertForSequenceClassificationGLUE(BertPreTrainedModel):
     config_class = BertConfig
-    pretrained_model_archive_map = BERT_PRETRAINED_MODEL_ARCHIVE_MAP
     base_model_prefix = "bert"
 
     def __init__(self, config):
@@ -6,7 +6,6 @@ import itertools
 import typing
 import math
 import warnings
-from torch._six import int_classes as _int_classes
 from torch.utils.data.dataset import ConcatDataset
 from torch.utils.data import (
     DataLoader,
@@ -286,7 +285,7 @@ class MTLDataset(Dataset):
             random.shuffle(rand_seq)
         lists = []
         limit = len(rand_seq) - 1
-        for i, group in enumerate(zip((*[iter(rand_seq)] * group_size))):
+        for i, group in enumerate(zip(*[iter(rand_seq)] * group_size)):
             delete_indexes = []
             for index, group_item in enumerate(group):
                 if group_item is None:
@@ -592,3 +591,43 @@ class MTLRandomSampler(Sampler):
         self.data_source.arrange_batches()
         # return SequentialSampler __iter__ since we already randomized
         return iter(range(len(self.data_source)))
+
+
+class DistributedMTLSampler(MTLRandomSampler):
+    """An MTLRandomSampler that shards whole batches across DDP ranks.
+
+    Every rank runs the same per-epoch re-sampling and arrangement (the
+    python/numpy seeds are shared across ranks, so all ranks agree on
+    the arranged instance order) and then keeps only its own
+    ``batch_size`` windows.  Sharding whole windows instead of
+    individual indices preserves the homogeneous/forced-heterogeneous
+    batch composition that ``arrange_batches`` builds.
+    """
+
+    def __init__(self, data_source, batch_size, num_replicas=None, rank=None):
+        super().__init__(data_source)
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __len__(self):
+        total = len(self.data_source)
+        stride = self.num_replicas * self.batch_size
+        return sum(
+            min(self.batch_size, total - start)
+            for start in range(self.rank * self.batch_size, total, stride)
+        )
+
+    def __iter__(self):
+        # the parent iterator re-samples and re-arranges the instances
+        # for this epoch on every rank
+        indices = list(super().__iter__())
+        stride = self.num_replicas * self.batch_size
+        for start in range(
+            self.rank * self.batch_size, len(indices), stride
+        ):
+            yield from indices[start : start + self.batch_size]
@@ -19,28 +19,33 @@
 # pylint: disable=not-callable
 
 import argparse
-import glob
+import copy
+import datetime
+import hashlib
+import itertools
 import json
 import logging
+import operator
 import os
 import random
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 import torch
+from filelock import FileLock
 from torch.utils.data import (
     DataLoader,
     RandomSampler,
     SequentialSampler,
     TensorDataset,
 )
-from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
 from transformers import (
     WEIGHTS_NAME,
-    AdamW,
+    AutoTokenizer,
     AlbertConfig,
     AlbertForSequenceClassification,
     AlbertTokenizer,
@@ -76,11 +81,27 @@ try:
 except ImportError:
     from tensorboardX import SummaryWriter
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from safetensors import safe_open
+except ImportError:
+    safe_open = None
+
+SAFETENSORS_WEIGHTS_NAME = "model.safetensors"
+
 from src.transferprediction.huggingface_extensions import (
     RobertaForSequenceClassificationGLUE,
     BertForSequenceClassificationGLUE,
 )
-from src.transferprediction.multi_dataloader import MTLDataset, MTLRandomSampler
+from src.transferprediction.multi_dataloader import (
+    DistributedMTLSampler,
+    MTLDataset,
+    MTLRandomSampler,
+)
 
 from src.transferprediction.utils import (
     processors,
@@ -91,23 +112,6 @@ from src.transferprediction.utils import (
 
 logger = logging.getLogger(__name__)
 
-ALL_MODELS = sum(
-    (
-        tuple(conf.pretrained_config_archive_map.keys())
-        for conf in (
-            BertConfig,
-            XLNetConfig,
-            XLMConfig,
-            RobertaConfig,
-            DistilBertConfig,
-            AlbertConfig,
-            XLMRobertaConfig,
-            FlaubertConfig,
-        )
-    ),
-    (),
-)
-
 MODEL_CLASSES = {
     "bert": (BertConfig, BertForSequenceClassificationGLUE, BertTokenizer),
     "xlnet": (XLNetConfig, XLNetForSequenceClassification, XLNetTokenizer),
@@ -136,29 +140,106 @@ MODEL_CLASSES = {
 }
 
 
+# output dirs created so far; skipping the redundant os.makedirs saves
+# a stat round-trip per call, which adds up on network filesystems
+_created_output_dirs = set()
+
+
+def _ensure_output_dir(path):
+    if path not in _created_output_dirs:
+        os.makedirs(path, exist_ok=True)
+        _created_output_dirs.add(path)
+
+
+def _nonempty(path):
+    # scandir stops at the first entry instead of materializing the
+    # whole listing the way os.listdir does
+    try:
+        with os.scandir(path) as entries:
+            return any(True for _ in entries)
+    except FileNotFoundError:
+        return False
+
+
 def set_seed(args):
     random.seed(args.seed)
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    # offset the torch seed per rank so dropout masks decorrelate across
+    # DDP processes; python/numpy stay shared since they drive the data
+    # ordering, which must agree across ranks
+    torch.manual_seed(args.seed + max(args.local_rank, 0))
+    if args.deterministic:
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+    else:
+        # let cuDNN pick the fastest algorithms and allow TF32 matmuls
+        # on Ampere+, a drop-in speedup for non-reproducible runs
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
     if args.n_gpu > 0:
-        torch.cuda.manual_seed_all(args.seed)
+        torch.cuda.manual_seed_all(args.seed + max(args.local_rank, 0))
+
+
+def _has_weights(path):
+    # save_pretrained writes model.safetensors under the pinned
+    # transformers; older checkpoints still carry pytorch_model.bin
+    return os.path.exists(
+        os.path.join(path, SAFETENSORS_WEIGHTS_NAME)
+    ) or os.path.exists(os.path.join(path, WEIGHTS_NAME))
+
+
+def read_checkpoint_state(checkpoint):
+    """Read a checkpoint's weights into CPU memory.
+
+    Runs on a background thread so the next checkpoint's disk read can
+    overlap the current one's evaluation.  Returns ``None`` when the
+    checkpoint has no weights file.
+    """
+    safetensors_path = os.path.join(checkpoint, SAFETENSORS_WEIGHTS_NAME)
+    if safe_open is not None and os.path.exists(safetensors_path):
+        with safe_open(safetensors_path, framework="pt", device="cpu") as fin:
+            return {key: fin.get_tensor(key) for key in fin.keys()}
+    weights_path = os.path.join(checkpoint, WEIGHTS_NAME)
+    if os.path.exists(weights_path):
+        return torch.load(weights_path, map_location="cpu")
+    return None
+
+
+def save_training_args(args, output_dir):
+    # a small json is cheaper to write and read back than a pickled
+    # Namespace, and downstream readers don't need torch to inspect it
+    safe_args = {
+        key: value
+        if isinstance(value, (str, int, float, bool, list, dict, type(None)))
+        else str(value)
+        for key, value in vars(args).items()
+    }
+    with open(os.path.join(output_dir, "training_args.json"), "w") as fout:
+        json.dump(safe_args, fout, indent=2, sort_keys=True)
 
 
 def save_model(args, model, tokenizer, optimizer, scheduler, global_step):
     output_dir = os.path.join(
         args.output_dir, "checkpoint-{}".format(global_step)
     )
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    _ensure_output_dir(output_dir)
+    # strip the torch.compile wrapper first so the checkpoint keys are
+    # not _orig_mod.-prefixed, then the DDP/parallel wrapper
+    model_to_save = getattr(model, "_orig_mod", model)
     model_to_save = (
-        model.module if hasattr(model, "module") else model
+        model_to_save.module
+        if hasattr(model_to_save, "module")
+        else model_to_save
     )  # Take care of distributed/parallel training
+    # save_pretrained writes model.safetensors (with format metadata)
+    # by default, which is the flat tensor storage the
+    # eval-all-checkpoints loop prefers for its fast cold reloads
     model_to_save.save_pretrained(output_dir)
     tokenizer.save_pretrained(output_dir)
 
-    torch.save(args, os.path.join(output_dir, "training_args.bin"))
+    save_training_args(args, output_dir)
     logger.info("Saving model checkpoint to %s", output_dir)
 
     torch.save(
@@ -175,45 +256,64 @@ def save_model(args, model, tokenizer, optimizer, scheduler, global_step):
     )
 
 
-def train(args, train_dataset, model, tokenizer):
+def collate_by_task(batch: typing.List):
+    """
+    Group the instances in the batch by their task index (the last
+    element of each instance tuple).  Sorting with a C-level key and
+    grouping the contiguous runs avoids the per-instance Python
+    bucketing loop; tasks absent from the batch simply produce no
+    sub-batch.
+
+    Returns:
+        A list of ``(collated_batch, task_int)`` tuples, one per task
+        present in the batch
+    """
+    if len(batch) == 0:
+        raise Exception("Empty task lists")
+    batch = sorted(batch, key=operator.itemgetter(-1))
+
+    # group them in their lists using the detault collate func; the
+    # task index rides along as a plain int so the training loop
+    # never has to pull it off the device
+    final_batches = [
+        (
+            torch.utils.data.dataloader.default_collate(list(task_group)),
+            task,
+        )
+        for task, task_group in itertools.groupby(
+            batch, key=operator.itemgetter(-1)
+        )
+    ]
+    return final_batches
+
+
+def train(args, train_dataset, model, tokenizer, scaler=None):
     """Train the model"""
     if args.local_rank in [-1, 0]:
         tb_writer = SummaryWriter()
 
-    def collate_func(batch: typing.List):
-        """
-        Here we see if the instances are already grouped by task.  If they are, batch them for speed
-        in processing.  If they're not, create a new sub-batch for that task.
-
-        Returns:
-            A list of lists where each list is instances for a task
-        """
-        batches_by_task = [[] for i in range(len(args.data_dir_list))]
-        for instance in batch:
-            cur_index = instance[-1]
-            batches_by_task[cur_index].append(instance)
-
-        # if by size, it may be zero from one task
-        batch_lens = [len(cur_batch) for cur_batch in batches_by_task]
-        if sum(batch_lens) == 0:
-            raise Exception("Empty task lists")
-        elif 0 in batch_lens:
-            batches_by_task = [
-                cur_batch
-                for cur_batch in batches_by_task
-                if len(cur_batch) != 0
-            ]
-
-        # group them in their lists using the detault collate func
-        final_batches = [
-            torch.utils.data.dataloader.default_collate(batch)
-            for batch in batches_by_task
-        ]
-        return final_batches
-
+    # both samplers run the per-epoch re-sampling/arrangement in
+    # MTLRandomSampler.__iter__; the distributed variant additionally
+    # shards whole batch windows across ranks so batch composition
+    # survives DDP
     train_sampler = (
-        MTLRandomSampler(train_dataset) if args.local_rank == -1 else None
-    )  # TODO: maybe add distributed capabilities
+        MTLRandomSampler(train_dataset)
+        if args.local_rank == -1
+        else DistributedMTLSampler(train_dataset, args.train_batch_size)
+    )
+
+    # pinned host buffers let the H2D copies overlap the previous step's
+    # compute (together with non_blocking=True below)
+    dataloader_kwargs = {
+        "pin_memory": args.device.type == "cuda",
+        "num_workers": args.num_workers,
+        # persistent workers would keep their fork-time copy of the
+        # dataset, but MTLRandomSampler re-arranges the instances in the
+        # parent process every epoch; the workers must be re-forked so
+        # they see the fresh arrangement (the eval loader's immutable
+        # TensorDataset can keep its workers alive)
+        "persistent_workers": False,
+    }
 
     if (
         "dnc" in args.output_dir or "size_experiment" in args.output_dir
@@ -224,8 +324,9 @@ def train(args, train_dataset, model, tokenizer):
             sampler=train_sampler,
             batch_size=args.train_batch_size,
             collate_fn=lambda x: [
-                torch.utils.data.dataloader.default_collate(x)
+                (torch.utils.data.dataloader.default_collate(x), x[0][-1])
             ],
+            **dataloader_kwargs,
         )
     else:
         print("Using split dataloaders...")
@@ -233,7 +334,8 @@ def train(args, train_dataset, model, tokenizer):
             train_dataset,
             sampler=train_sampler,
             batch_size=args.train_batch_size,
-            collate_fn=collate_func,
+            collate_fn=collate_by_task,
+            **dataloader_kwargs,
         )
 
     if args.max_steps > 0:
@@ -251,30 +353,29 @@ def train(args, train_dataset, model, tokenizer):
         )
 
     # Prepare optimizer and schedule (linear warmup and decay)
-    no_decay = ["bias", "LayerNorm.weight"]
+    # partition the parameters in a single pass instead of scanning
+    # every name twice
+    no_decay = ("bias", "LayerNorm.weight")
+    decay_params, no_decay_params = [], []
+    for name, param in model.named_parameters():
+        if any(nd in name for nd in no_decay):
+            no_decay_params.append(param)
+        else:
+            decay_params.append(param)
     optimizer_grouped_parameters = [
-        {
-            "params": [
-                p
-                for n, p in model.named_parameters()
-                if not any(nd in n for nd in no_decay)
-            ],
-            "weight_decay": args.weight_decay,
-        },
-        {
-            "params": [
-                p
-                for n, p in model.named_parameters()
-                if any(nd in n for nd in no_decay)
-            ],
-            "weight_decay": 0.0,
-        },
+        {"params": decay_params, "weight_decay": args.weight_decay},
+        {"params": no_decay_params, "weight_decay": 0.0},
     ]
 
-    optimizer = AdamW(
+    # the fused CUDA kernel collapses the per-parameter python loop of
+    # transformers.AdamW into a single horizontally-fused launch
+    optimizer = torch.optim.AdamW(
         optimizer_grouped_parameters,
         lr=args.learning_rate,
         eps=args.adam_epsilon,
+        # keyed off the parameters' device, not the machine: --no_cuda
+        # on a CUDA host keeps everything on CPU
+        fused=args.device.type == "cuda",
     )
     scheduler = get_linear_schedule_with_warmup(
         optimizer,
@@ -299,30 +400,25 @@ def train(args, train_dataset, model, tokenizer):
             torch.load(os.path.join(args.model_name_or_path, "scheduler.pt"))
         )
 
-    # if args.fp16:
-    #     try:
-    #         from apex import amp
-    #     except ImportError:
-    #         raise ImportError(
-    #             "Please install apex from https://www.github.com/nvidia/apex to use fp16 training."
-    #         )
-    #     model, optimizer = amp.initialize(
-    #         model, optimizer, opt_level=args.fp16_opt_level
-    #     )
-
-    # multi-gpu training (should be after apex fp16 initialization)
-    if args.n_gpu > 1:
-        model = torch.nn.DataParallel(model)
-
-    # Distributed training (should be after apex fp16 initialization)
-    if args.local_rank != -1:
-        model = torch.nn.parallel.DistributedDataParallel(
-            model,
-            device_ids=[args.local_rank],
-            output_device=args.local_rank,
-            find_unused_parameters=True,
+    # FP16 needs loss scaling to avoid gradient underflow; BF16 does not
+    if scaler is None:
+        scaler = torch.cuda.amp.GradScaler(enabled=args.precision == "fp16")
+    amp_dtype = args.amp_dtype or torch.float16
+    amp_enabled = args.amp_dtype is not None
+
+    if args.compile:
+        # collate_by_task produces shape-stable (batch, max_seq_length)
+        # inputs, so a single specialized graph per shape suffices
+        model = torch.compile(
+            model, mode="reduce-overhead", fullgraph=False, dynamic=False
         )
 
+    # the forward reads num_labels off the bare module, so strip the
+    # compile and DDP wrappers once here; assigning on a wrapper would
+    # silently leave every task on the head the model started with
+    unwrapped_model = getattr(model, "_orig_mod", model)
+    unwrapped_model = getattr(unwrapped_model, "module", unwrapped_model)
+
     # Train!
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_dataset))
@@ -365,158 +461,211 @@ def train(args, train_dataset, model, tokenizer):
             steps_trained_in_current_epoch,
         )
 
-    tr_loss, logging_loss = 0.0, 0.0
-    model.zero_grad()
+    # accumulate the loss on-device; calling .item() every step forces a
+    # device-host sync, so only sync at logging boundaries
+    tr_loss = torch.zeros((), device=args.device)
+    model.zero_grad(set_to_none=True)
     train_iterator = trange(
         epochs_trained,
         int(args.num_train_epochs),
         desc="Epoch",
         disable=args.local_rank not in [-1, 0],
+        mininterval=2.0,
     )
-    if not os.path.isdir(args.output_dir):
-        os.makedirs(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
     num_instances = 0
-    for epoch in train_iterator:
-        in_epoch_iterator = tqdm(
-            train_dataloader,
-            desc="Iteration",
-            disable=args.local_rank not in [-1, 0],
-        )
+    # hold one handle for the life of train() instead of reopening (and
+    # flushing on close) the loss log every epoch
+    loss_fout = (
+        open(os.path.join(args.output_dir, "loss_values.txt"), "a")
+        if args.local_rank in [-1, 0]
+        else None
+    )
+    try:
+        for epoch in train_iterator:
+            # throttle the refreshes: per-step formatting and locking is
+            # measurable interpreter overhead for small batches
+            in_epoch_iterator = tqdm(
+                train_dataloader,
+                desc="Iteration",
+                disable=args.local_rank not in [-1, 0],
+                mininterval=2.0,
+                miniters=max(1, len(train_dataloader) // 200),
+            )
 
-        if args.sampling_type == "dynamic":
-            # HACK: this is not very clean, but it does work
-            results = evaluate(args, model, tokenizer)
-            train_dataloader.dataset.evaluation_metrics = results
-            train_dataloader.dataset.old_evaluation_metrics = False
-
-        model.zero_grad()
-        all_losses = []
-        half_of_batch = len(in_epoch_iterator) // 2
-        for step, batch_all in enumerate(in_epoch_iterator):
-            # Skip past any already trained steps if resuming training
-            if steps_trained_in_current_epoch > 0:
-                steps_trained_in_current_epoch -= 1
-                continue
+            if args.sampling_type == "dynamic":
+                # HACK: this is not very clean, but it does work
+                results = evaluate(args, unwrapped_model, tokenizer)
+                train_dataloader.dataset.evaluation_metrics = results
+                train_dataloader.dataset.old_evaluation_metrics = False
 
-            if step == half_of_batch:
-                print("Saving model at half of epoch...")
-                save_model(
-                    args, model, tokenizer, optimizer, scheduler, global_step
+            # once per epoch (and after any dynamic-sampling evaluation that
+            # flipped the model to eval mode), not once per sub-batch
+            model.train()
+            model.zero_grad(set_to_none=True)
+            all_losses = []
+            half_of_batch = len(in_epoch_iterator) // 2
+            # Skip past any already trained steps if resuming training;
+            # slicing the iterator advances it without running the loop
+            # body on batches that would just be discarded
+            if steps_trained_in_current_epoch > 0:
+                batch_iterator = enumerate(
+                    itertools.islice(
+                        in_epoch_iterator,
+                        steps_trained_in_current_epoch,
+                        None,
+                    ),
+                    start=steps_trained_in_current_epoch,
                 )
+                steps_trained_in_current_epoch = 0
+            else:
+                batch_iterator = enumerate(in_epoch_iterator)
+            for step, batch_all in batch_iterator:
 
-            loss = None
-            for batch_with_task in batch_all:
-                batch, task_index = batch_with_task[:-1], batch_with_task[-1]
-                model.train()
-
-                # the num labels decides on classification or regression
-                if task_index.dim() > 1:
-                    task_index = task_index.squeeze(0)
-                all_tasks_in_batch = list(set(task_index.tolist()))
-                # assert len(all_tasks_in_batch) == 1, "batch had different tasks"
-                model.num_labels = args.num_label_list[all_tasks_in_batch[0]]
-
-                batch = tuple(t.to(args.device) for t in batch)
-                # inputs should be dim=2 (batch_size, seq_len) for input_ids etc. and dim=1 for labels
-                inputs = {
-                    "input_ids": batch[0].squeeze(1)
-                    if batch[0].dim() > 2
-                    else batch[0],
-                    "attention_mask": batch[1].squeeze(1)
-                    if batch[1].dim() > 2
-                    else batch[1],
-                    "labels": batch[3].squeeze(0)
-                    if batch[3].dim() > 1
-                    else batch[3],
-                }
-                if args.model_type != "distilbert":
-                    tokens = (
-                        batch[2].squeeze(1) if batch[2].dim() > 2 else batch[2]
+                if step == half_of_batch:
+                    print("Saving model at half of epoch...")
+                    save_model(
+                        args, model, tokenizer, optimizer, scheduler, global_step
                     )
-                    inputs["token_type_ids"] = (
-                        tokens
-                        if args.model_type in ["bert", "xlnet", "albert"]
-                        else None
-                    )
-                    # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
-                num_instances += inputs["input_ids"].shape[0]
-                outputs = model(**inputs)
-                sub_loss = outputs[
-                    0
-                ]  # model outputs are always tuple in transformers (see doc)
-
-                if args.n_gpu > 1:
-                    loss = (
-                        loss.mean()
-                    )  # mean() to average on multi-gpu parallel training
-                loss = sub_loss if loss is None else loss + sub_loss
-
-            # only do the rest every batch
-            if args.gradient_accumulation_steps > 1:
-                loss = loss / args.gradient_accumulation_steps
-
-            if args.fp16:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                loss.backward()
 
-            tr_loss += loss.item()
-            if (step + 1) % args.gradient_accumulation_steps == 0:
-                if args.fp16:
-                    torch.nn.utils.clip_grad_norm_(
-                        amp.master_params(optimizer), args.max_grad_norm
+                loss = None
+                for collated_batch, task_int in batch_all:
+                    # drop the collated task-index tensor; each sub-batch is
+                    # homogeneous by construction
+                    batch = collated_batch[:-1]
+
+                    # the num labels decides on classification or regression
+                    unwrapped_model.num_labels = args.num_label_list[task_int]
+
+                    batch = tuple(
+                        t.to(args.device, non_blocking=True) for t in batch
                     )
-                else:
+                    # the embedding lookup needs int64; cast after the
+                    # (smaller) transfer so the copy still moves fewer bytes
+                    batch = tuple(
+                        t.to(torch.long)
+                        if t.dtype in (torch.int32, torch.int8)
+                        else t
+                        for t in batch
+                    )
+                    # inputs should be dim=2 (batch_size, seq_len) for input_ids etc. and dim=1 for labels
+                    inputs = {
+                        "input_ids": batch[0].squeeze(1)
+                        if batch[0].dim() > 2
+                        else batch[0],
+                        "attention_mask": batch[1].squeeze(1)
+                        if batch[1].dim() > 2
+                        else batch[1],
+                        "labels": batch[3].squeeze(0)
+                        if batch[3].dim() > 1
+                        else batch[3],
+                    }
+                    if args.model_type != "distilbert":
+                        tokens = (
+                            batch[2].squeeze(1) if batch[2].dim() > 2 else batch[2]
+                        )
+                        inputs["token_type_ids"] = (
+                            tokens
+                            if args.model_type in ["bert", "xlnet", "albert"]
+                            else None
+                        )
+                        # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
+                    num_instances += inputs["input_ids"].shape[0]
+                    with torch.amp.autocast(
+                        device_type="cuda",
+                        dtype=amp_dtype,
+                        enabled=amp_enabled,
+                    ):
+                        outputs = model(**inputs)
+                        sub_loss = outputs[
+                            0
+                        ]  # model outputs are always tuple in transformers (see doc)
+
+                    loss = sub_loss if loss is None else loss + sub_loss
+
+                # only do the rest every batch
+                if args.gradient_accumulation_steps > 1:
+                    loss = loss / args.gradient_accumulation_steps
+
+                # the scaler is a no-op unless --fp16 is set (BF16 keeps the
+                # FP32 exponent range, so it needs no loss scaling)
+                scaler.scale(loss).backward()
+
+                tr_loss += loss.detach()
+                if (step + 1) % args.gradient_accumulation_steps == 0:
+                    scaler.unscale_(optimizer)
                     torch.nn.utils.clip_grad_norm_(
                         model.parameters(), args.max_grad_norm
                     )
-                all_losses.append(loss.item())
-                optimizer.step()
-                scheduler.step()  # Update learning rate schedule
-                model.zero_grad()
-                global_step += 1
+                    all_losses.append(loss.detach())
+                    scaler.step(optimizer)
+                    scaler.update()
+                    scheduler.step()  # Update learning rate schedule
+                    model.zero_grad(set_to_none=True)
+                    global_step += 1
+
+                if args.max_steps > 0 and global_step > args.max_steps:
+                    in_epoch_iterator.close()
+                    break
+
+            if args.local_rank in [-1, 0]:
+                # Save model checkpoint every epoch
+                # want to get a fairly accurate estimate
+                end_of_epoch_loss = (
+                    torch.stack(all_losses[-10:]).mean().item()
+                    if all_losses
+                    else float("nan")
+                )
+                all_losses = []
+                loss_fout.write(
+                    "epoch {} loss {}\n".format(epoch, end_of_epoch_loss)
+                )
+                print("Saving model at end of epoch...")
+                save_model(
+                    args, model, tokenizer, optimizer, scheduler, global_step
+                )
 
             if args.max_steps > 0 and global_step > args.max_steps:
-                in_epoch_iterator.close()
+                train_iterator.close()
                 break
 
-        if args.local_rank in [-1, 0]:
-            # Save model checkpoint every epoch
-            # want to get a fairly accurate estimate
-            end_of_epoch_loss = np.array(all_losses[-10:]).mean()
-            all_losses = []
-            with open(
-                os.path.join(args.output_dir, "loss_values.txt"), "a"
-            ) as fout:
-                fout.write("epoch {} loss {}".format(epoch, end_of_epoch_loss))
-                fout.write("\n")
-            print("Saving model at end of epoch...")
-            save_model(
-                args, model, tokenizer, optimizer, scheduler, global_step
-            )
-
-        if args.max_steps > 0 and global_step > args.max_steps:
-            train_iterator.close()
-            break
+    finally:
+        if loss_fout is not None:
+            loss_fout.close()
 
     if args.local_rank in [-1, 0]:
         tb_writer.close()
 
-    return global_step, tr_loss / global_step
+    return global_step, tr_loss.item() / global_step
 
 
 def get_grad_of_loss(model) -> torch.tensor:
-    list_of_grads = []
+    # compute the mean incrementally instead of materializing an O(P)
+    # concatenation of every gradient just to reduce it to a scalar
+    total = torch.zeros((), device=next(model.parameters()).device)
+    count = 0
     for n, p in model.named_parameters():
+        if not p.requires_grad:
+            continue
         if p.grad is not None:
-            list_of_grads.append(p.grad.view(-1))
+            total += p.grad.sum()
+            count += p.grad.numel()
 
-    mean_grad_of_loss = torch.cat(list_of_grads).mean()
+    mean_grad_of_loss = total / count
     return mean_grad_of_loss
 
 
 def evaluate(args, model, tokenizer, prefix=""):
+    if args.quantize_eval and not args.do_train and args.device.type == "cpu":
+        # dynamic INT8 quantization of the Linear layers speeds up the
+        # encoder GEMMs on CPU; the latency is very thread-sensitive so
+        # use every core available
+        torch.set_num_threads(os.cpu_count())
+        model.eval()
+        model = torch.quantization.quantize_dynamic(
+            model.cpu(), {torch.nn.Linear}, dtype=torch.qint8
+        )
+
     # Loop to handle MNLI double evaluation (matched, mis-matched)
     eval_task_name_list = []
     eval_output_dirs_list = []
@@ -548,11 +697,8 @@ def evaluate(args, model, tokenizer, prefix=""):
                 shorten=args.short,
             )
 
-            if not os.path.exists(eval_output_dir) and args.local_rank in [
-                -1,
-                0,
-            ]:
-                os.makedirs(eval_output_dir)
+            if args.local_rank in [-1, 0]:
+                _ensure_output_dir(eval_output_dir)
 
             args.eval_batch_size = args.per_gpu_eval_batch_size * max(
                 1, args.n_gpu
@@ -563,6 +709,9 @@ def evaluate(args, model, tokenizer, prefix=""):
                 eval_dataset,
                 sampler=eval_sampler,
                 batch_size=args.eval_batch_size,
+                pin_memory=args.device.type == "cuda",
+                num_workers=args.num_workers,
+                persistent_workers=args.num_workers > 0,
             )
 
             # multi-gpu eval
@@ -573,17 +722,47 @@ def evaluate(args, model, tokenizer, prefix=""):
             logger.info("***** Running evaluation {} *****".format(prefix))
             logger.info("  Num examples = %d", len(eval_dataset))
             logger.info("  Batch size = %d", args.eval_batch_size)
+            # the task -> num_labels lookup is loop-invariant; resolve
+            # it once instead of a string replace + list search per batch
+            model.num_labels = args.num_label_list[
+                args.task_names.index(eval_task.replace("-mm", ""))
+            ]
+            model.eval()
             eval_loss = 0.0
             nb_eval_steps = 0
-            preds = None
-            out_label_ids = None
-            for batch in tqdm(eval_dataloader, desc="Evaluating"):
-
-                model.num_labels = args.num_label_list[
-                    args.task_names.index(eval_task.replace("-mm", ""))
-                ]
-                model.eval()
-                batch = tuple(t.to(args.device) for t in batch)
+            # preallocate the dev-set buffers once; growing them with
+            # np.append re-copies everything accumulated so far on every
+            # batch.  the argmax/squeeze happens on-device, so only the
+            # final predictions cross PCIe, not the full logits
+            preds = np.empty(
+                len(eval_dataset),
+                dtype=np.int64
+                if output_mode == "classification"
+                else np.float32,
+            )
+            out_label_ids = np.empty(
+                len(eval_dataset),
+                dtype=np.int64
+                if output_mode == "classification"
+                else np.float32,
+            )
+            offset = 0
+            for batch in tqdm(
+                eval_dataloader,
+                desc="Evaluating",
+                mininterval=2.0,
+                miniters=max(1, len(eval_dataloader) // 200),
+            ):
+
+                batch = tuple(
+                    t.to(args.device, non_blocking=True) for t in batch
+                )
+                batch = tuple(
+                    t.to(torch.long)
+                    if t.dtype in (torch.int32, torch.int8)
+                    else t
+                    for t in batch
+                )
 
                 with torch.no_grad():
                     inputs = {
@@ -597,29 +776,35 @@ def evaluate(args, model, tokenizer, prefix=""):
                             if args.model_type in ["bert", "xlnet", "albert"]
                             else None
                         )  # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
-                    outputs = model(**inputs)
+                    with torch.amp.autocast(
+                        device_type="cuda",
+                        dtype=args.amp_dtype or torch.bfloat16,
+                        enabled=args.amp_dtype is not None,
+                    ):
+                        outputs = model(**inputs)
                     tmp_eval_loss, logits = outputs[:2]
 
                     eval_loss += tmp_eval_loss.mean().item()
                 nb_eval_steps += 1
-                if preds is None:
-                    preds = logits.detach().cpu().numpy()
-                    out_label_ids = inputs["labels"].detach().cpu().numpy()
-                else:
-                    preds = np.append(
-                        preds, logits.detach().cpu().numpy(), axis=0
+                cur_batch_size = logits.shape[0]
+                if output_mode == "classification":
+                    preds_batch = (
+                        logits.argmax(dim=1).to(torch.int64).cpu().numpy()
                     )
-                    out_label_ids = np.append(
-                        out_label_ids,
-                        inputs["labels"].detach().cpu().numpy(),
-                        axis=0,
+                else:
+                    # numpy has no bfloat16, so widen the autocast output
+                    # before it leaves the device; this also writes full
+                    # fp32 into the preallocated buffer under fp16
+                    preds_batch = (
+                        logits.detach().squeeze(-1).float().cpu().numpy()
                     )
+                preds[offset : offset + cur_batch_size] = preds_batch
+                out_label_ids[offset : offset + cur_batch_size] = (
+                    inputs["labels"].detach().cpu().numpy()
+                )
+                offset += cur_batch_size
 
             eval_loss = eval_loss / nb_eval_steps
-            if output_mode == "classification":
-                preds = np.argmax(preds, axis=1)
-            elif output_mode == "regression":
-                preds = np.squeeze(preds)
             result = compute_metrics(eval_task, preds, out_label_ids)
             results.update(result)
 
@@ -627,8 +812,7 @@ def evaluate(args, model, tokenizer, prefix=""):
                 eval_output_dir, prefix, "eval_results.txt"
             )
             print("Eval results to", output_eval_file)
-            if not os.path.isdir(os.path.join(eval_output_dir, prefix)):
-                os.makedirs(os.path.join(eval_output_dir, prefix))
+            _ensure_output_dir(os.path.join(eval_output_dir, prefix))
             with open(output_eval_file, "w") as writer:
                 logger.info("***** Eval results {} *****".format(prefix))
                 for key in sorted(result.keys()):
@@ -654,26 +838,48 @@ def load_and_cache_examples(
     except Exception:
         processor = processors[task[:-1]]()
         output_mode = output_modes[task[:-1]]
-    # Load data features from cache or dataset file
-    name_to_use = (
-        args.model_type
-        if "/" in args.model_name_or_path
-        else args.model_name_or_path
-    )
+    # Load data features from cache or dataset file.  Key the cache on
+    # everything that changes the features, so runs with the same
+    # tokenizer settings reuse it without needing --overwrite_cache
+    cache_signature = hashlib.sha1(
+        repr(
+            (
+                tokenizer.__class__.__name__,
+                getattr(tokenizer, "name_or_path", args.model_name_or_path),
+                getattr(tokenizer, "model_max_length", None),
+                args.max_seq_length,
+                task,
+                evaluate,
+            )
+        ).encode()
+    ).hexdigest()[:16]
     cached_features_file = os.path.join(
         data_dir,
-        "cached_{}_{}_{}_{}".format(
-            "dev" if evaluate else "train",
-            list(filter(None, args.model_name_or_path.split("/"))).pop(),
-            str(args.max_seq_length),
-            str(task),
-        ),
-    )
-    if os.path.exists(cached_features_file) and not args.overwrite_cache:
+        "cached_{}_{}".format("dev" if evaluate else "train", cache_signature),
+    )
+    feature_fields = (
+        "input_ids",
+        "attention_mask",
+        "token_type_ids",
+        "labels",
+    )
+    cache_paths = {
+        field: "{}.{}.npy".format(cached_features_file, field)
+        for field in feature_fields
+    }
+    if (
+        all(os.path.exists(path) for path in cache_paths.values())
+        and not args.overwrite_cache
+    ):
         logger.info(
             "Loading features from cached file %s", cached_features_file
         )
-        features = torch.load(cached_features_file)
+        # memory-mapped loads are zero-copy: the OS page cache serves the
+        # bytes directly with no per-feature unpickling
+        arrays = {
+            field: np.load(path, mmap_mode="r")
+            for field, path in cache_paths.items()
+        }
     else:
         logger.info("Creating features from dataset file at %s", data_dir)
         label_list = processor.get_labels()
@@ -689,53 +895,114 @@ def load_and_cache_examples(
             if evaluate
             else processor.get_train_examples(data_dir)
         )
-        try:
+        if shorten:
+            examples = examples[:2]
+
+        if getattr(tokenizer, "is_fast", False) and args.model_type not in [
+            "xlnet"
+        ]:
+            # fast (Rust) tokenizers batch across all examples in one
+            # GIL-free call instead of looping example-by-example in
+            # Python.  xlnet stays on the slow path for its left-padding
+            # and segment-id conventions
+            text_b_list = [example.text_b for example in examples]
+            encoded = tokenizer(
+                [example.text_a for example in examples],
+                text_b_list if any(b is not None for b in text_b_list) else None,
+                padding="max_length",
+                truncation=True,
+                max_length=args.max_seq_length,
+                return_token_type_ids=True,
+                return_attention_mask=True,
+            )
+            arrays = {
+                "input_ids": np.asarray(
+                    encoded["input_ids"], dtype=np.int32
+                ),
+                "attention_mask": np.asarray(
+                    encoded["attention_mask"], dtype=np.int8
+                ),
+                "token_type_ids": np.asarray(
+                    encoded["token_type_ids"], dtype=np.int8
+                ),
+            }
+            if output_mode == "classification":
+                label_map = {
+                    label: index for index, label in enumerate(label_list)
+                }
+                arrays["labels"] = np.array(
+                    [label_map[example.label] for example in examples],
+                    dtype=np.int64,
+                )
+            else:
+                arrays["labels"] = np.array(
+                    [float(example.label) for example in examples],
+                    dtype=np.float32,
+                )
+        else:
+            # padding side and segment-id conventions now come from the
+            # tokenizer itself (the pad_* kwargs were dropped from the
+            # transformers API)
             features = convert_examples_to_features(
-                examples[:2] if shorten else examples,
+                examples,
                 tokenizer,
                 label_list=label_list,
                 max_length=args.max_seq_length,
                 output_mode=output_mode,
-                pad_on_left=bool(
-                    args.model_type in ["xlnet"]
-                ),  # pad on the left for xlnet
-                pad_token=tokenizer.convert_tokens_to_ids(
-                    [tokenizer.pad_token]
-                )[0],
-                pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
             )
-        except Exception as e:
-            print(e)
-            raise (e)
+
+            # Convert to arrays right away.  Fill pre-sized numpy arrays
+            # instead of building nested Python lists for `torch.tensor`,
+            # so the per-element copies happen in C rather than the
+            # interpreter
+            num_features, seq_length = len(features), args.max_seq_length
+            # vocab ids fit in int32 and masks/segment ids in int8; the
+            # smaller dtypes shrink the cache files, the pinned
+            # DataLoader buffers, and the H2D copies.  the train/eval
+            # loops cast back to int64 after the transfer
+            arrays = {
+                "input_ids": np.empty(
+                    (num_features, seq_length), dtype=np.int32
+                ),
+                "attention_mask": np.empty(
+                    (num_features, seq_length), dtype=np.int8
+                ),
+                "token_type_ids": np.empty(
+                    (num_features, seq_length), dtype=np.int8
+                ),
+            }
+            for index, feature in enumerate(features):
+                arrays["input_ids"][index] = feature.input_ids
+                arrays["attention_mask"][index] = feature.attention_mask
+                # models without segment embeddings (e.g. roberta) leave
+                # token_type_ids unset
+                arrays["token_type_ids"][index] = (
+                    feature.token_type_ids
+                    if feature.token_type_ids is not None
+                    else 0
+                )
+            arrays["labels"] = np.array(
+                [f.label for f in features],
+                dtype=np.int64
+                if output_mode == "classification"
+                else np.float32,
+            )
 
         if args.local_rank in [-1, 0]:
             logger.info(
                 "Saving features into cached file %s", cached_features_file
             )
-            torch.save(features, cached_features_file)
+            for field, path in cache_paths.items():
+                np.save(path, arrays[field])
 
     if args.local_rank == 0 and not evaluate:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor(
-        [f.input_ids for f in features], dtype=torch.long
-    )
-    all_attention_mask = torch.tensor(
-        [f.attention_mask for f in features], dtype=torch.long
-    )
-    all_token_type_ids = torch.tensor(
-        [f.token_type_ids for f in features], dtype=torch.long
-    )
-    if output_mode == "classification":
-        all_labels = torch.tensor([f.label for f in features], dtype=torch.long)
-    elif output_mode == "regression":
-        all_labels = torch.tensor(
-            [f.label for f in features], dtype=torch.float
-        )
-
     dataset = TensorDataset(
-        all_input_ids, all_attention_mask, all_token_type_ids, all_labels
+        torch.from_numpy(arrays["input_ids"]),
+        torch.from_numpy(arrays["attention_mask"]),
+        torch.from_numpy(arrays["token_type_ids"]),
+        torch.from_numpy(arrays["labels"]),
     )
     return dataset
 
@@ -764,8 +1031,7 @@ def main():
         default=None,
         type=str,
         required=True,
-        help="Path to pre-trained model or shortcut name selected in the list: "
-        + ", ".join(ALL_MODELS),
+        help="Path to pre-trained model or shortcut name from huggingface.co/models",
     )
     parser.add_argument(
         "--task_names",
@@ -931,17 +1197,49 @@ def main():
     parser.add_argument(
         "--seed", type=int, default=42, help="random seed for initialization"
     )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the model with torch.compile for fused forward/backward graphs",
+    )
+    parser.add_argument(
+        "--deterministic",
+        action="store_true",
+        help="Force deterministic cuDNN algorithms; disables cuDNN benchmark and TF32 matmuls",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="Number of DataLoader worker processes for training and evaluation.",
+    )
+    parser.add_argument(
+        "--quantize_eval",
+        action="store_true",
+        help="Quantize the linear layers to INT8 for eval-only runs on CPU",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Whether to use bfloat16 mixed precision (requires Ampere or newer GPUs)",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "fp16", "bf16"],
+        help="Autocast precision for training and evaluation; supersedes --fp16/--bf16.",
+    )
     parser.add_argument(
         "--fp16",
         action="store_true",
-        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
+        help="Whether to use 16-bit (mixed) precision (through torch.cuda.amp) instead of 32-bit",
     )
     parser.add_argument(
         "--fp16_opt_level",
         type=str,
-        default="O1",
-        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-        "See details at https://nvidia.github.io/apex/amp.html",
+        default=None,
+        help="Deprecated and ignored: apex AMP opt level; --fp16 uses native torch.cuda.amp.",
     )
     parser.add_argument(
         "--local_rank",
@@ -982,10 +1280,9 @@ def main():
     args = parser.parse_args()
 
     if (
-        os.path.exists(args.output_dir)
-        and os.listdir(args.output_dir)
-        and args.do_train
+        args.do_train
         and not args.overwrite_output_dir
+        and _nonempty(args.output_dir)
     ):
         raise ValueError(
             "Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(
@@ -1014,27 +1311,63 @@ def main():
         )
         ptvsd.wait_for_attach()
 
+    # Setup logging before the CUDA setup so the device line below is
+    # actually emitted
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO if args.local_rank in [-1, 0] else logging.WARN,
+    )
+
     # Setup CUDA, GPU & distributed training
     if args.local_rank == -1 or args.no_cuda:
         device = torch.device(
             "cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu"
         )
-        args.n_gpu = torch.cuda.device_count()
+        args.n_gpu = 0 if args.no_cuda else torch.cuda.device_count()
     else:  # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.cuda.set_device(args.local_rank)
         device = torch.device("cuda", args.local_rank)
-        torch.distributed.init_process_group(backend="nccl")
+        # surface collective failures as exceptions instead of hanging,
+        # and cap the wait so a dead rank fails the job within minutes
+        os.environ.setdefault("NCCL_ASYNC_ERROR_HANDLING", "1")
+        if os.environ.get("NCCL_SOCKET_IFNAME"):
+            logger.info(
+                "NCCL_SOCKET_IFNAME=%s", os.environ["NCCL_SOCKET_IFNAME"]
+            )
+        torch.distributed.init_process_group(
+            backend="nccl", timeout=datetime.timedelta(minutes=10)
+        )
         args.n_gpu = 1
+    if args.local_rank == -1 and args.n_gpu > 1 and args.do_train:
+        raise ValueError(
+            "Multi-GPU training uses DistributedDataParallel; launch with"
+            " `torchrun --nproc_per_node={}` instead of relying on"
+            " DataParallel".format(args.n_gpu)
+        )
     args.device = device
-    print(f"Using device {device}, ")
+    logger.info("Using device %s", device)
+
+    # fold the legacy --fp16/--bf16 switches into --precision, and keep
+    # the autocast dtype on args so train/evaluate agree on it.  only
+    # FP16 needs the GradScaler; BF16 has the FP32 exponent range
+    if args.precision == "fp32":
+        if args.bf16:
+            args.precision = "bf16"
+        elif args.fp16:
+            args.precision = "fp16"
+    args.amp_dtype = {
+        "fp32": None,
+        "fp16": torch.float16,
+        "bf16": torch.bfloat16,
+    }[args.precision]
+    if args.precision == "bf16" and not (
+        torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    ):
+        raise ValueError(
+            "bf16 requires a CUDA device with bfloat16 support (Ampere or newer)"
+        )
     set_seed(args)  # Added here for reproductibility
-
-    # Setup logging
-    logging.basicConfig(
-        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
-        datefmt="%m/%d/%Y %H:%M:%S",
-        level=logging.INFO if args.local_rank in [-1, 0] else logging.WARN,
-    )
     logger.warning(
         "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
         args.local_rank,
@@ -1043,6 +1376,10 @@ def main():
         bool(args.local_rank != -1),
         args.fp16,
     )
+    if args.fp16_opt_level is not None:
+        logger.warning(
+            "--fp16_opt_level is deprecated and ignored; --fp16 uses native torch.cuda.amp"
+        )
 
     # Prepare GLUE task
     processor_list = []
@@ -1060,75 +1397,136 @@ def main():
 
     args.num_label_list = num_label_list
 
-    # create needed task/data_dirs
-    data_dirs = args.data_dirs.split(" ")
-    print(f"Data dirs are {data_dirs}")
+    # create needed task/data_dirs; whitespace split drops the empty
+    # strings a doubled space would otherwise smuggle in
+    data_dirs = [d for d in args.data_dirs.split() if d]
+    logger.info("Data dirs are %s", data_dirs)
     args.data_dir_list = data_dirs
-    args.task_list = [item.lower() for item in args.task_names]
-    print("Working with tasks {}".format(args.task_list))
-    print("Working with data_dirs", args.data_dir_list)
+    args.task_list = args.task_names  # already lowered above
+    logger.info("Working with tasks %s", args.task_list)
+    logger.info("Working with data_dirs %s", args.data_dir_list)
 
     if args.sampling_type == "dynamic":
         single_scores = pd.read_csv(
             args.single_task_scores, header=0, index_col=0
         )
+        # one dict conversion up front beats a pandas .loc lookup per
+        # task, each of which re-runs the index machinery
+        score_map = single_scores.iloc[:, 0].to_dict()
         args.single_task_scores = [
-            single_scores.loc[dir_name.split("/")[-1].split("_")[0]][0]
+            score_map[dir_name.split("/")[-1].split("_")[0]]
             for dir_name in data_dirs
         ]
 
-    # Load pretrained model and tokenizer
-    if args.local_rank not in [-1, 0]:
-        torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
-
     args.model_type = args.model_type.lower()
     config_class, model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
-    config = config_class.from_pretrained(
-        args.config_name if args.config_name else args.model_name_or_path,
-        num_labels=num_label_list[0],
-        finetuning_task=args.task_names[0],
-        cache_dir=args.cache_dir if args.cache_dir else None,
-    )
-    tokenizer = tokenizer_class.from_pretrained(
-        args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
-        do_lower_case=args.do_lower_case,
-        cache_dir=args.cache_dir if args.cache_dir else None,
-    )
-    model = model_class.from_pretrained(
-        args.model_name_or_path,
-        from_tf=bool(".ckpt" in args.model_name_or_path),
-        config=config,
-        cache_dir=args.cache_dir if args.cache_dir else None,
-    )
-
-    if args.local_rank == 0:
-        torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
+    if args.do_train or args.do_eval:
+        # Load pretrained model and tokenizer (skipped entirely when the
+        # invocation neither trains nor evaluates, e.g. cache-warming
+        # runs).  A filesystem lock keeps the "only one rank downloads"
+        # invariant without parking the other ranks on an NCCL barrier,
+        # a well-documented startup hang point
+        download_lock = FileLock(
+            os.path.join(
+                args.cache_dir if args.cache_dir else "/tmp",
+                "hf_download.lock",
+            )
+        )
+        with download_lock:
+            config = config_class.from_pretrained(
+                args.config_name
+                if args.config_name
+                else args.model_name_or_path,
+                num_labels=num_label_list[0],
+                finetuning_task=args.task_names[0],
+                cache_dir=args.cache_dir if args.cache_dir else None,
+            )
+            # the fast (Rust) tokenizer unlocks batched, GIL-free
+            # encoding in load_and_cache_examples
+            tokenizer = AutoTokenizer.from_pretrained(
+                args.tokenizer_name
+                if args.tokenizer_name
+                else args.model_name_or_path,
+                do_lower_case=args.do_lower_case,
+                cache_dir=args.cache_dir if args.cache_dir else None,
+                use_fast=True,
+            )
+            model = model_class.from_pretrained(
+                args.model_name_or_path,
+                from_tf=bool(".ckpt" in args.model_name_or_path),
+                config=config,
+                cache_dir=args.cache_dir if args.cache_dir else None,
+            )
 
-    model.to(args.device)
+        model.to(args.device, non_blocking=True)
+
+        # multi-gpu training always goes through DDP (one process per
+        # GPU, launched via torchrun); wrapping once here, right after
+        # the move to the device, keeps the bucket allocation off the
+        # training path.  every parameter gets a gradient each step, so
+        # skipping the unused-parameter search saves a graph traversal
+        # per iteration
+        if args.local_rank != -1:
+            model = torch.nn.parallel.DistributedDataParallel(
+                model,
+                device_ids=[args.local_rank],
+                output_device=args.local_rank,
+                find_unused_parameters=False,
+                gradient_as_bucket_view=True,
+            )
 
     logger.info("Training/evaluation parameters %s", args)
 
     # Training
     if args.do_train:
-        train_datasets = []
-        for index, task_name in enumerate(args.task_names):
-            train_datasets.append(
+        if args.local_rank == -1:
+            # the per-task loads are dominated by disk reads and
+            # tokenization, both of which release the GIL, so they
+            # overlap well across threads.  each task gets its own
+            # tokenizer copy: calling a shared fast tokenizer mutates
+            # the underlying Rust object and races with "Already
+            # borrowed" errors
+            with ThreadPoolExecutor(
+                max_workers=min(8, len(args.task_names))
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        load_and_cache_examples,
+                        args,
+                        args.task_list[index],
+                        args.data_dir_list[index],
+                        copy.deepcopy(tokenizer),
+                        False,
+                        args.short,
+                    )
+                    for index in range(len(args.task_names))
+                ]
+                train_datasets = [future.result() for future in futures]
+        else:
+            # load_and_cache_examples issues torch.distributed barriers,
+            # and concurrent collectives on one process group deadlock;
+            # distributed runs load sequentially
+            train_datasets = [
                 load_and_cache_examples(
                     args,
                     args.task_list[index],
                     args.data_dir_list[index],
                     tokenizer,
-                    evaluate=False,
-                    shorten=args.short,
+                    False,
+                    args.short,
                 )
-            )
-        args.train_batch_size = args.per_gpu_train_batch_size * max(
-            1, args.n_gpu
-        )
+                for index in range(len(args.task_names))
+            ]
+        # under DDP each process drives a single GPU, so the per-gpu
+        # batch size is the per-process batch size
+        args.train_batch_size = args.per_gpu_train_batch_size
         train_dataset = MTLDataset(
             args, train_datasets, args.train_batch_size, args.single_task_scores
         )
-        global_step, tr_loss = train(args, train_dataset, model, tokenizer)
+        scaler = torch.cuda.amp.GradScaler(enabled=args.precision == "fp16")
+        global_step, tr_loss = train(
+            args, train_dataset, model, tokenizer, scaler
+        )
         logger.info(
             " global_step = %s, average loss = %s", global_step, tr_loss
         )
@@ -1144,64 +1542,120 @@ def main():
         logger.info("Saving model checkpoint to %s", args.output_dir)
         # Save a trained model, configuration and tokenizer using `save_pretrained()`.
         # They can then be reloaded using `from_pretrained()`
+        model_to_save = getattr(model, "_orig_mod", model)
         model_to_save = (
-            model.module if hasattr(model, "module") else model
+            model_to_save.module
+            if hasattr(model_to_save, "module")
+            else model_to_save
         )  # Take care of distributed/parallel training
         model_to_save.save_pretrained(args.output_dir)
         tokenizer.save_pretrained(args.output_dir)
 
         # Good practice: save your training arguments together with the trained model
-        torch.save(args, os.path.join(args.output_dir, "training_args.bin"))
+        save_training_args(args, args.output_dir)
 
-        # Load a trained model and vocabulary that you have fine-tuned
-        model = model_class.from_pretrained(args.output_dir)
-        tokenizer = tokenizer_class.from_pretrained(args.output_dir)
-        model.to(args.device)
+        # the in-memory model/tokenizer already are the trained
+        # artifacts; reloading what was just written would only redo the
+        # deserialize + H2D copy
 
     # Evaluation
     results = {}
     if args.do_eval and args.local_rank in [-1, 0]:
-        tokenizer = tokenizer_class.from_pretrained(
-            args.output_dir, do_lower_case=args.do_lower_case
-        )
+        if not args.do_train:
+            # eval-only runs load the tokenizer saved alongside the
+            # checkpoints; after training the in-memory one is identical.
+            # the same fast-tokenizer call as the training path keeps the
+            # feature-cache key (tokenizer class name) consistent
+            tokenizer = AutoTokenizer.from_pretrained(
+                args.output_dir,
+                do_lower_case=args.do_lower_case,
+                use_fast=True,
+            )
         checkpoints = [args.output_dir]
         if args.eval_all_checkpoints:
-            checkpoints = list(
-                os.path.dirname(c)
-                for c in sorted(
-                    glob.glob(
-                        args.output_dir + "/**/" + WEIGHTS_NAME, recursive=True
-                    )
-                )
+            # one single-depth scandir over the known checkpoint-* naming
+            # instead of a recursive glob that stats every file in the
+            # output tree
+            checkpoints = sorted(
+                (
+                    entry.path
+                    for entry in os.scandir(args.output_dir)
+                    if entry.is_dir()
+                    and entry.name.startswith("checkpoint-")
+                    and _has_weights(entry.path)
+                ),
+                key=lambda path: int(path.rsplit("-", 1)[1]),
             )
+            if _has_weights(args.output_dir):
+                checkpoints = [args.output_dir] + checkpoints
             logging.getLogger("transformers.modeling_utils").setLevel(
                 logging.WARN
             )  # Reduce logging
         logger.info("Evaluate the following checkpoints: %s", checkpoints)
-        for checkpoint in checkpoints:
-            global_step = (
-                checkpoint.split("-")[-1] if len(checkpoints) > 1 else ""
-            )
-            prefix = (
-                checkpoint.split("/")[-1]
-                if checkpoint.find("checkpoint") != -1
-                else ""
+        # build the module graph once; every checkpoint shares the same
+        # architecture, so the loop only swaps weights into the tensors
+        # already allocated on the device instead of re-running
+        # from_pretrained per checkpoint
+        if not args.do_train and checkpoints:
+            model = model_class.from_pretrained(checkpoints[0])
+            model.to(args.device, non_blocking=True)
+        # after DDP training, `model` is the wrapper whose state-dict
+        # keys carry a `module.` prefix; load into the bare module so
+        # the checkpoint keys line up
+        model_to_eval = model.module if hasattr(model, "module") else model
+        # a single background thread reads the next checkpoint's weights
+        # from disk while the current one evaluates, so the per-
+        # checkpoint latency is max(read, eval) rather than their sum
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            next_state = (
+                prefetcher.submit(read_checkpoint_state, checkpoints[0])
+                if checkpoints
+                else None
             )
-            model = model_class.from_pretrained(checkpoint)
-            model.to(args.device)
-            result = evaluate(args, model, tokenizer, prefix=prefix)
-            result = dict(
-                (k + "_{}".format(global_step), v) for k, v in result.items()
-            )
-            results.update(result)
+            for index, checkpoint in enumerate(checkpoints):
+                global_step = (
+                    checkpoint.split("-")[-1] if len(checkpoints) > 1 else ""
+                )
+                prefix = (
+                    checkpoint.split("/")[-1]
+                    if checkpoint.find("checkpoint") != -1
+                    else ""
+                )
+                state = next_state.result()
+                if index + 1 < len(checkpoints):
+                    next_state = prefetcher.submit(
+                        read_checkpoint_state, checkpoints[index + 1]
+                    )
+                if state is None:
+                    logger.warning(
+                        "No weights file found in %s; skipping", checkpoint
+                    )
+                    continue
+                model_to_eval.load_state_dict(state)
+                del state
+                result = evaluate(
+                    args, model_to_eval, tokenizer, prefix=prefix
+                )
+                result = dict(
+                    (k + "_{}".format(global_step), v)
+                    for k, v in result.items()
+                )
+                results.update(result)
 
-    print(
-        "Writing `results.json` to file at {}".format(
-            os.path.join(args.output_dir, "results.json")
-        )
+    logger.info(
+        "Writing `results.json` to file at %s",
+        os.path.join(args.output_dir, "results.json"),
     )
-    with open(os.path.join(args.output_dir, "results.json"), "w") as fout:
-        fout.write(json.dumps(results))
+    if orjson is not None:
+        # orjson serializes straight to bytes an order of magnitude
+        # faster than the stdlib encoder
+        with open(os.path.join(args.output_dir, "results.json"), "wb") as fout:
+            # compute_metrics returns numpy scalars, which orjson only
+            # accepts with the numpy option
+            fout.write(orjson.dumps(results, option=orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(os.path.join(args.output_dir, "results.json"), "w") as fout:
+            json.dump(results, fout)
     return results
 
 
@@ -0,0 +1,115 @@
+"""Tests for transferprediction.run_glue.py"""
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+
+import torch
+from transformers import AutoTokenizer
+
+from transferprediction.run_glue import (
+    collate_by_task,
+    load_and_cache_examples,
+)
+
+
+def make_instance(value: int, task: int):
+    """Build an instance tuple the way MTLDataset.get_all_instances does:
+    a tuple of chunked tensors with the task index riding along as a
+    plain int in the last position."""
+    return (
+        torch.full((1, 4), value, dtype=torch.long),
+        torch.ones((1, 4), dtype=torch.long),
+        torch.tensor([value], dtype=torch.long),
+        task,
+    )
+
+
+class CollateByTask(unittest.TestCase):
+    def test_multi_task_batch_groups_by_task(self):
+        batch = [
+            make_instance(0, 1),
+            make_instance(1, 0),
+            make_instance(2, 1),
+            make_instance(3, 0),
+            make_instance(4, 2),
+        ]
+        sub_batches = collate_by_task(batch)
+        assert len(sub_batches) == 3, "expected one sub-batch per task"
+        tasks = [task for _, task in sub_batches]
+        assert tasks == [0, 1, 2], "sub-batches should be sorted by task"
+        for _, task in sub_batches:
+            assert isinstance(task, int), "task index should stay a python int"
+        sizes = [collated[0].shape[0] for collated, _ in sub_batches]
+        assert sizes == [2, 2, 1], "instances landed in the wrong sub-batch"
+        # the instances for task 0 were values 1 and 3
+        task_zero_batch = sub_batches[0][0]
+        assert sorted(task_zero_batch[2].flatten().tolist()) == [1, 3]
+
+    def test_single_task_batch_is_one_group(self):
+        batch = [make_instance(value, 7) for value in range(5)]
+        sub_batches = collate_by_task(batch)
+        assert len(sub_batches) == 1, "single-task batch should not split"
+        collated, task = sub_batches[0]
+        assert task == 7
+        assert collated[0].shape[0] == 5
+
+    def test_empty_batch_raises(self):
+        with self.assertRaises(Exception):
+            collate_by_task([])
+
+
+class NpyCacheRoundTrip(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = AutoTokenizer.from_pretrained(
+            "distilroberta-base",
+            do_lower_case=True,
+            cache_dir=None,
+            use_fast=True,
+        )
+        cls.data_dir = tempfile.mkdtemp()
+        shutil.copy(
+            os.path.join("tests", "fixtures", "dataset", "CoLA", "train.tsv"),
+            cls.data_dir,
+        )
+        cls.args = Namespace(
+            model_type="roberta",
+            model_name_or_path="distilroberta-base",
+            max_seq_length=128,
+            local_rank=-1,
+            overwrite_cache=False,
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir)
+
+    def test_cache_round_trip(self):
+        first = load_and_cache_examples(
+            self.args, "cola", self.data_dir, self.tokenizer, shorten=True
+        )
+        cache_files = glob.glob(
+            os.path.join(self.data_dir, "cached_train_*.npy")
+        )
+        assert (
+            len(cache_files) == 4
+        ), "expected one .npy file per feature field"
+
+        second = load_and_cache_examples(
+            self.args, "cola", self.data_dir, self.tokenizer, shorten=True
+        )
+        assert len(first.tensors) == len(second.tensors)
+        for built, cached in zip(first.tensors, second.tensors):
+            assert torch.equal(
+                torch.as_tensor(built), torch.as_tensor(cached)
+            ), "cached features differ from freshly built ones"
+
+        input_ids, attention_mask, token_type_ids, labels = second.tensors
+        assert input_ids.dtype == torch.int32
+        assert attention_mask.dtype == torch.int8
+        assert token_type_ids.dtype == torch.int8
+        assert labels.dtype == torch.int64